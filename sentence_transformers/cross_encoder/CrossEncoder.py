@@ -1,14 +1,19 @@
 
 from transformers import AutoModelForSequenceClassification, AutoTokenizer, AutoConfig
 import numpy as np
+import inspect
 import logging
+import math
 import os
+from contextlib import ExitStack
 from typing import Dict, Type, Callable, List
 import transformers
 import torch
 from torch import nn
 from torch.optim import Optimizer
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, DistributedSampler, RandomSampler
+from torch.nn.parallel import DistributedDataParallel
+import torch.distributed as dist
 from tqdm.autonotebook import tqdm, trange
 from .. import SentenceTransformer, util
 from ..evaluation import SentenceEvaluator
@@ -19,7 +24,7 @@ logger = logging.getLogger(__name__)
 
 class CrossEncoder():
     def __init__(self, model_name:str, num_labels:int = None, max_length:int = None, device:str = None, tokenizer_args:Dict = {},
-                  automodel_args:Dict = {}, default_activation_function = None):
+                  automodel_args:Dict = {}, default_activation_function = None, compile_model: bool = False):
         """
         A CrossEncoder takes exactly two sentences / texts as input and either predicts
         a score or label for this sentence pair. It can for example predict the similarity of the sentence pair
@@ -34,6 +39,7 @@ class CrossEncoder():
         :param tokenizer_args: Arguments passed to AutoTokenizer
         :param automodel_args: Arguments passed to AutoModelForSequenceClassification
         :param default_activation_function: Callable (like nn.Sigmoid) about the default activation function that should be used on-top of model.predict(). If None. nn.Sigmoid() will be used if num_labels=1, else nn.Identity()
+        :param compile_model: If True, the model is compiled with torch.compile (requires PyTorch >= 2.0) for faster training and inference. The first batches are slow as the model is compiled for the new input shapes. Inputs are padded to a multiple of 32 tokens (or to a multiple of the largest divisor of max_length up to 32, e.g. 25 for max_length=100) to limit the number of recompilations.
         """
 
         self.config = AutoConfig.from_pretrained(model_name)
@@ -51,6 +57,27 @@ class CrossEncoder():
         self.tokenizer = AutoTokenizer.from_pretrained(model_name, **tokenizer_args)
         self.max_length = max_length
 
+        self._compiled_model = None
+        if compile_model:
+            if hasattr(torch, 'compile'):
+                self._compiled_model = torch.compile(self.model)
+            else:
+                logger.warning("compile_model=True requires PyTorch >= 2.0. The model will not be compiled")
+
+        #Pad to a few fixed lengths so that the compiled model can be reused across batches.
+        #The tokenizer requires the truncation length to be a multiple of pad_to_multiple_of, so we use the largest divisor of it up to 32
+        self._pad_to_multiple_of = None
+        if self._compiled_model is not None:
+            truncation_length = self.max_length if self.max_length is not None else self.tokenizer.model_max_length
+            self._pad_to_multiple_of = max(divisor for divisor in range(1, 33) if int(truncation_length) % divisor == 0)
+            if self._pad_to_multiple_of < 8:
+                logger.warning("max_length={} has no divisor between 8 and 32. Inputs are padded to a multiple of {}, which can lead to many recompilations of the model. Use e.g. a max_length that is a multiple of 32".format(truncation_length, self._pad_to_multiple_of))
+            elif self._pad_to_multiple_of < 32:
+                logger.info("max_length={} is not a multiple of 32. Inputs are padded to a multiple of {} instead".format(truncation_length, self._pad_to_multiple_of))
+
+        #onnxruntime.InferenceSession used by predict(), see from_onnx
+        self._onnx_session = None
+
         if device is None:
             device = "cuda" if torch.cuda.is_available() else "cpu"
             logger.info("Use pytorch device: {}".format(device))
@@ -69,34 +96,19 @@ class CrossEncoder():
             self.default_activation_function = nn.Sigmoid() if self.config.num_labels == 1 else nn.Identity()
 
     def smart_batching_collate(self, batch):
-        texts = [[] for _ in range(len(batch[0].texts))]
-        labels = []
-
-        for example in batch:
-            for idx, text in enumerate(example.texts):
-                texts[idx].append(text.strip())
-
-            labels.append(example.label)
-
-        tokenized = self.tokenizer(*texts, padding=True, truncation='longest_first', return_tensors="pt", max_length=self.max_length)
-        labels = torch.tensor(labels, dtype=torch.float if self.config.num_labels == 1 else torch.long).to(self._target_device)
+        #Transpose the batch into one list per text position
+        texts = [[text.strip() for text in column] for column in zip(*[example.texts for example in batch])]
+        labels = [example.label for example in batch]
 
-        for name in tokenized:
-            tokenized[name] = tokenized[name].to(self._target_device)
+        tokenized = self.tokenizer(*texts, padding=True, truncation='longest_first', return_tensors="pt", max_length=self.max_length, pad_to_multiple_of=self._pad_to_multiple_of)
+        labels = torch.tensor(labels, dtype=torch.float if self.config.num_labels == 1 else torch.long)
 
         return tokenized, labels
 
     def smart_batching_collate_text_only(self, batch):
-        texts = [[] for _ in range(len(batch[0]))]
+        texts = [[text.strip() for text in column] for column in zip(*batch)]
 
-        for example in batch:
-            for idx, text in enumerate(example):
-                texts[idx].append(text.strip())
-
-        tokenized = self.tokenizer(*texts, padding=True, truncation='longest_first', return_tensors="pt", max_length=self.max_length)
-
-        for name in tokenized:
-            tokenized[name] = tokenized[name].to(self._target_device)
+        tokenized = self.tokenizer(*texts, padding=True, truncation='longest_first', return_tensors="pt", max_length=self.max_length, pad_to_multiple_of=self._pad_to_multiple_of)
 
         return tokenized
 
@@ -117,7 +129,9 @@ class CrossEncoder():
             max_grad_norm: float = 1,
             use_amp: bool = False,
             callback: Callable[[float, int, int], None] = None,
-            show_progress_bar: bool = True
+            show_progress_bar: bool = True,
+            local_rank: int = -1,
+            gradient_accumulation_steps: int = 1
             ):
         """
         Train the model with the given training objective
@@ -129,7 +143,7 @@ class CrossEncoder():
         :param evaluator: An evaluator (sentence_transformers.evaluation) evaluates the model performance during training on held-out dev data. It is used to determine the best model that is saved to disc.
         :param epochs: Number of epochs for training
         :param loss_fct: Which loss function to use for training. If None, will use nn.BCEWithLogitsLoss() if self.config.num_labels == 1 else nn.CrossEntropyLoss()
-        :param activation_fct: Activation function applied on top of logits output of model.
+        :param activation_fct: Activation function applied on top of logits output of model. The default loss functions expect raw logits, so keep nn.Identity() (the sigmoid is applied inside nn.BCEWithLogitsLoss) unless you pass your own loss_fct.
         :param scheduler: Learning rate scheduler. Available schedulers: constantlr, warmupconstant, warmuplinear, warmupcosine, warmupcosinewithhardrestarts
         :param warmup_steps: Behavior depends on the scheduler. For WarmupLinear (default), the learning rate is increased from o up to the maximal learning rate. After these many training steps, the learning rate is decreased linearly back to zero.
         :param optimizer_class: Optimizer
@@ -144,7 +158,32 @@ class CrossEncoder():
                 It must accept the following three parameters in this order:
                 `score`, `epoch`, `steps`
         :param show_progress_bar: If True, output a tqdm progress bar
+        :param local_rank: Local rank of this process for multi-GPU training with DistributedDataParallel, e.g. int(os.environ['LOCAL_RANK']) when started with torchrun.
+                Each process trains on its own shard of train_dataloader.dataset. Evaluation and saving is only done by the process with rank 0. If -1, trains on a single device
+        :param gradient_accumulation_steps: Number of batches whose gradients are accumulated before each optimizer step. The effective batch size is batch_size * gradient_accumulation_steps (per process).
+                warmup_steps and evaluation_steps count optimizer steps
         """
+        distributed = local_rank != -1
+        if distributed:
+            if not dist.is_initialized():
+                dist.init_process_group(backend='nccl' if torch.cuda.is_available() else 'gloo')
+
+            if torch.cuda.is_available():
+                torch.cuda.set_device(local_rank)
+                self._target_device = torch.device('cuda', local_rank)
+
+            if train_dataloader.batch_size is None:
+                raise ValueError("Distributed training requires a train_dataloader with a batch_size and without a custom batch_sampler")
+
+            #Each process trains on its own shard of the dataset
+            train_sampler = DistributedSampler(train_dataloader.dataset, shuffle=isinstance(train_dataloader.sampler, RandomSampler))
+            train_dataloader = DataLoader(train_dataloader.dataset, batch_size=train_dataloader.batch_size, sampler=train_sampler,
+                                          num_workers=train_dataloader.num_workers, drop_last=train_dataloader.drop_last, pin_memory=train_dataloader.pin_memory)
+
+            if dist.get_rank() != 0:
+                evaluator = None
+                show_progress_bar = False
+
         train_dataloader.collate_fn = self.smart_batching_collate
 
         if use_amp:
@@ -152,12 +191,17 @@ class CrossEncoder():
             scaler = torch.cuda.amp.GradScaler()
 
         self.model.to(self._target_device)
+        model = self._compiled_model if self._compiled_model is not None else self.model
+
+        if distributed:
+            ddp_model = DistributedDataParallel(self.model, device_ids=[local_rank] if torch.cuda.is_available() else None, gradient_as_bucket_view=True)
+            model = torch.compile(ddp_model) if self._compiled_model is not None else ddp_model
 
         if output_path is not None:
             os.makedirs(output_path, exist_ok=True)
 
         self.best_score = -9999999
-        num_train_steps = int(len(train_dataloader) * epochs)
+        num_train_steps = int(math.ceil(len(train_dataloader) / gradient_accumulation_steps) * epochs)
 
         # Prepare optimizers
         param_optimizer = list(self.model.named_parameters())
@@ -175,42 +219,59 @@ class CrossEncoder():
 
         if loss_fct is None:
             loss_fct = nn.BCEWithLogitsLoss() if self.config.num_labels == 1 else nn.CrossEntropyLoss()
+            if isinstance(activation_fct, (nn.Sigmoid, nn.Softmax)):
+                logger.warning("The default loss function {} expects raw logits, but activation_fct={} is applied before it. Use activation_fct=nn.Identity() to avoid applying the activation twice".format(loss_fct.__class__.__name__, activation_fct.__class__.__name__))
 
 
         skip_scheduler = False
         for epoch in trange(epochs, desc="Epoch", disable=not show_progress_bar):
+            if distributed:
+                train_sampler.set_epoch(epoch)
+
             training_steps = 0
-            self.model.zero_grad()
+            self.model.zero_grad(set_to_none=True)
             self.model.train()
 
-            for features, labels in tqdm(train_dataloader, desc="Iteration", smoothing=0.05, disable=not show_progress_bar):
-                if use_amp:
-                    with autocast():
-                        model_predictions = self.model(**features, return_dict=True)
+            for batch_idx, (features, labels) in enumerate(self._prefetch_to_device(tqdm(train_dataloader, desc="Iteration", smoothing=0.05, disable=not show_progress_bar))):
+                is_accumulation_boundary = (batch_idx + 1) % gradient_accumulation_steps == 0 or batch_idx + 1 == len(train_dataloader)
+
+                #Gradients are only synchronized between the processes in the backward pass of the last accumulation step
+                sync_context = ddp_model.no_sync() if distributed and not is_accumulation_boundary else ExitStack()
+                with sync_context:
+                    if use_amp:
+                        with autocast():
+                            model_predictions = model(**features, return_dict=True)
+                            logits = activation_fct(model_predictions.logits)
+                            if self.config.num_labels == 1:
+                                logits = logits.view(-1)
+                            loss_value = loss_fct(logits, labels) / gradient_accumulation_steps
+
+                        scaler.scale(loss_value).backward()
+                    else:
+                        model_predictions = model(**features, return_dict=True)
                         logits = activation_fct(model_predictions.logits)
                         if self.config.num_labels == 1:
                             logits = logits.view(-1)
-                        loss_value = loss_fct(logits, labels)
+                        loss_value = loss_fct(logits, labels) / gradient_accumulation_steps
+                        loss_value.backward()
+
+                if not is_accumulation_boundary:
+                    continue
 
+                if use_amp:
                     scale_before_step = scaler.get_scale()
-                    scaler.scale(loss_value).backward()
                     scaler.unscale_(optimizer)
                     torch.nn.utils.clip_grad_norm_(self.model.parameters(), max_grad_norm)
                     scaler.step(optimizer)
                     scaler.update()
 
-                    skip_scheduler = scaler.get_scale() != scale_before_step
+                    #The scaler only reduces its scale if it skipped the optimizer step due to inf/NaN gradients
+                    skip_scheduler = scaler.get_scale() < scale_before_step
                 else:
-                    model_predictions = self.model(**features, return_dict=True)
-                    logits = activation_fct(model_predictions.logits)
-                    if self.config.num_labels == 1:
-                        logits = logits.view(-1)
-                    loss_value = loss_fct(logits, labels)
-                    loss_value.backward()
                     torch.nn.utils.clip_grad_norm_(self.model.parameters(), max_grad_norm)
                     optimizer.step()
 
-                optimizer.zero_grad()
+                optimizer.zero_grad(set_to_none=True)
 
                 if not skip_scheduler:
                     scheduler.step()
@@ -220,7 +281,7 @@ class CrossEncoder():
                 if evaluator is not None and evaluation_steps > 0 and training_steps % evaluation_steps == 0:
                     self._eval_during_training(evaluator, output_path, save_best_model, epoch, training_steps, callback)
 
-                    self.model.zero_grad()
+                    self.model.zero_grad(set_to_none=True)
                     self.model.train()
 
             if evaluator is not None:
@@ -235,7 +296,8 @@ class CrossEncoder():
                activation_fct = None,
                apply_softmax = False,
                convert_to_numpy: bool = True,
-               convert_to_tensor: bool = False
+               convert_to_tensor: bool = False,
+               use_amp: bool = False
                ):
         """
         Performs predicts with the CrossEncoder on the given sentence pairs.
@@ -248,6 +310,7 @@ class CrossEncoder():
         :param convert_to_numpy: Convert the output to a numpy matrix.
         :param apply_softmax: If there are more than 2 dimensions and apply_softmax=True, applies softmax on the logits output
         :param convert_to_tensor:  Conver the output to a tensor.
+        :param use_amp: Run the model with Automatic Mixed Precision (FP16 autocast). Only has an effect on CUDA devices
         :return: Predictions for the passed sentence pairs
         """
         input_was_string = False
@@ -255,7 +318,14 @@ class CrossEncoder():
             sentences = [sentences]
             input_was_string = True
 
-        inp_dataloader = DataLoader(sentences, batch_size=batch_size, collate_fn=self.smart_batching_collate_text_only, num_workers=num_workers, shuffle=False)
+        #Sort the pairs by length, so that each batch is padded to a similar length
+        length_sorted_idx = np.argsort([-self._text_length(sentence_pair) for sentence_pair in sentences])
+        sentences_sorted = [sentences[idx] for idx in length_sorted_idx]
+
+        #Let each worker tokenize a few batches ahead (prefetch_factor can only be set with worker processes)
+        worker_args = {'prefetch_factor': 4} if num_workers > 0 else {}
+        inp_dataloader = DataLoader(sentences_sorted, batch_size=batch_size, collate_fn=self.smart_batching_collate_text_only, num_workers=num_workers, shuffle=False,
+                                    pin_memory=self._target_device.type == 'cuda', **worker_args)
 
         if show_progress_bar is None:
             show_progress_bar = (logger.getEffectiveLevel() == logging.INFO or logger.getEffectiveLevel() == logging.DEBUG)
@@ -270,22 +340,30 @@ class CrossEncoder():
         pred_scores = []
         self.model.eval()
         self.model.to(self._target_device)
-        with torch.no_grad():
-            for features in iterator:
-                model_predictions = self.model(**features, return_dict=True)
-                logits = activation_fct(model_predictions.logits)
+        model = self._compiled_model if self._compiled_model is not None else self.model
+        #ExitStack() is used as a no-op context manager, contextlib.nullcontext requires Python 3.7
+        amp_context = torch.cuda.amp.autocast() if use_amp else ExitStack()
+        with torch.no_grad(), amp_context:
+            for features in (iterator if self._onnx_session is not None else self._prefetch_to_device(iterator)):
+                if self._onnx_session is not None:
+                    logits = self._onnx_forward(features)
+                else:
+                    logits = model(**features, return_dict=True).logits
+                logits = activation_fct(logits.float())
 
                 if apply_softmax and len(logits[0]) > 1:
                     logits = torch.nn.functional.softmax(logits, dim=1)
-                pred_scores.extend(logits)
+                pred_scores.append(logits)
+
+        pred_scores = torch.cat(pred_scores)
+        pred_scores = pred_scores[torch.from_numpy(np.argsort(length_sorted_idx)).to(pred_scores.device)]
 
         if self.config.num_labels == 1:
-            pred_scores = [score[0] for score in pred_scores]
+            pred_scores = pred_scores.view(-1)
 
-        if convert_to_tensor:
-            pred_scores = torch.stack(pred_scores)
-        elif convert_to_numpy:
-            pred_scores = np.asarray([score.cpu().detach().numpy() for score in pred_scores])
+        if not convert_to_tensor:
+            #Copy all scores to the cpu at once
+            pred_scores = pred_scores.cpu().numpy() if convert_to_numpy else list(pred_scores)
 
         if input_was_string:
             pred_scores = pred_scores[0]
@@ -293,6 +371,70 @@ class CrossEncoder():
         return pred_scores
 
 
+    def _prefetch_to_device(self, dataloader):
+        """
+        Iterates over the batches of dataloader and moves them to the target device.
+        On CUDA devices, the copy of the next batch is issued on a separate stream (non_blocking), so that
+        it overlaps with the computation on the current batch. Use a DataLoader with pin_memory=True for truly asynchronous copies.
+        """
+        if self._target_device.type == 'cpu':
+            #The collate functions already return cpu tensors
+            yield from dataloader
+            return
+
+        if self._target_device.type != 'cuda':
+            for batch in dataloader:
+                yield self._apply_to_tensors(batch, lambda tensor: tensor.to(self._target_device))
+            return
+
+        copy_stream = torch.cuda.Stream(device=self._target_device)
+
+        def wait_for_copy(batch, copy_done):
+            compute_stream = torch.cuda.current_stream(self._target_device)
+            compute_stream.wait_event(copy_done)
+
+            def record_stream(tensor):
+                #The memory of the tensors was allocated on copy_stream, but is now used on the compute stream
+                tensor.record_stream(compute_stream)
+                return tensor
+
+            return self._apply_to_tensors(batch, record_stream)
+
+        prefetched = None
+        for batch in dataloader:
+            with torch.cuda.stream(copy_stream):
+                batch = self._apply_to_tensors(batch, lambda tensor: tensor.to(self._target_device, non_blocking=True))
+                copy_done = copy_stream.record_event()
+
+            if prefetched is not None:
+                yield wait_for_copy(*prefetched)
+            prefetched = (batch, copy_done)
+
+        if prefetched is not None:
+            yield wait_for_copy(*prefetched)
+
+    @staticmethod
+    def _apply_to_tensors(batch, fct):
+        """
+        Applies fct to all tensors in a (nested) batch of tuples, lists and dicts
+        """
+        if isinstance(batch, torch.Tensor):
+            return fct(batch)
+
+        if isinstance(batch, (list, tuple)):
+            return type(batch)(CrossEncoder._apply_to_tensors(item, fct) for item in batch)
+
+        for name in batch:
+            batch[name] = CrossEncoder._apply_to_tensors(batch[name], fct)
+        return batch
+
+    @staticmethod
+    def _text_length(sentence_pair: List[str]):
+        """
+        Help function to get the length for the input sentence pair (sum of the character lengths of the texts)
+        """
+        return sum([len(text) for text in sentence_pair])
+
     def _eval_during_training(self, evaluator, output_path, save_best_model, epoch, steps, callback):
         """Runs evaluation during the training"""
         if evaluator is not None:
@@ -321,3 +463,51 @@ class CrossEncoder():
         """
         return self.save(path)
 
+    def export_onnx(self, path: str, opset_version: int = None):
+        """
+        Saves the model (see save) and exports it to ONNX as path/model.onnx, with dynamic batch size and sequence length.
+        The exported model can be loaded with CrossEncoder.from_onnx(path) to run predict() with onnxruntime
+
+        :param path: Folder to store the model
+        :param opset_version: ONNX opset version used for the export. If None, the default opset of the installed PyTorch version is used. Newer opsets require newer PyTorch versions (e.g. opset 13 requires PyTorch >= 1.8)
+        """
+        self.save(path)
+
+        features = self.smart_batching_collate_text_only([["A sentence", "Another sentence"]])
+        #The graph inputs follow the order of the forward() arguments, name them accordingly
+        features = {name: features[name].to(self._target_device) for name in inspect.signature(self.model.forward).parameters if name in features}
+        dynamic_axes = {name: {0: 'batch_size', 1: 'sequence_length'} for name in features}
+        dynamic_axes['logits'] = {0: 'batch_size'}
+
+        self.model.eval()
+        self.model.to(self._target_device)
+        with torch.no_grad():
+            torch.onnx.export(self.model, (features,), os.path.join(path, 'model.onnx'), input_names=list(features), output_names=['logits'],
+                              dynamic_axes=dynamic_axes, opset_version=opset_version)
+
+    @classmethod
+    def from_onnx(cls, path: str, providers: List = None, **kwargs):
+        """
+        Loads a CrossEncoder that was exported with export_onnx. predict() then runs the ONNX model with onnxruntime
+        (pip install onnxruntime, or onnxruntime-gpu for CUDA / TensorRT). fit() still trains the PyTorch model, export it again afterwards.
+
+        :param path: Folder with the exported model
+        :param providers: onnxruntime execution providers in order of preference, e.g. [('TensorrtExecutionProvider', {'trt_fp16_enable': True}), 'CUDAExecutionProvider']. If None, all available providers are used
+        :param kwargs: Further arguments passed to CrossEncoder.__init__
+        """
+        import onnxruntime
+
+        model = cls(path, **kwargs)
+        if providers is None:
+            providers = onnxruntime.get_available_providers()
+        model._onnx_session = onnxruntime.InferenceSession(os.path.join(path, 'model.onnx'), providers=providers)
+        return model
+
+    def _onnx_forward(self, features):
+        """
+        Runs the onnxruntime session on the tokenized features and returns the logits as tensor
+        """
+        input_names = [session_input.name for session_input in self._onnx_session.get_inputs()]
+        logits = self._onnx_session.run(['logits'], {name: features[name].numpy() for name in input_names})[0]
+        return torch.from_numpy(logits)
+
@@ -3,7 +3,7 @@ import torch
 from torch import Tensor
 import logging
 from tqdm import tqdm, trange
-from ..util import cos_sim, dot_score
+from ..util import cos_sim, dot_score, batch_to_device
 import os
 import numpy as np
 from typing import List, Tuple, Dict, Set, Callable
@@ -35,7 +35,9 @@ class InformationRetrievalEvaluator(SentenceEvaluator):
                  name: str = '',
                  write_csv: bool = True,
                  score_functions: List[Callable[[Tensor, Tensor], Tensor] ] = {'cos_sim': cos_sim, 'dot_score': dot_score},       #Score function, higher=more similar
-                 main_score_function: str = None
+                 main_score_function: str = None,
+                 cache_corpus_tokenization: bool = False,     #Tokenize the corpus only once and re-use it for later evaluations. Requires a SentenceTransformer as corpus model and keeps the tokenized corpus in memory
+                 fp16_scores: bool = False      #Compute the cos_sim scores with FP16 embeddings on CUDA devices. Faster for large corpora, the ranking can differ slightly for nearly tied scores. Other score functions use FP32, as unnormalized embeddings can overflow in FP16
                  ):
 
         self.queries_ids = []
@@ -49,6 +51,13 @@ class InformationRetrievalEvaluator(SentenceEvaluator):
         self.corpus = [corpus[cid] for cid in self.corpus_ids]
 
         self.relevant_docs = relevant_docs
+
+        #Encode each (query, relevant doc) pair as query_idx * len(corpus) + corpus_idx, so relevance can be looked up with np.isin
+        corpus_id_to_idx = {cid: idx for idx, cid in enumerate(self.corpus_ids)}
+        self._relevant_pair_keys = np.sort(np.array([query_idx * len(self.corpus_ids) + corpus_id_to_idx[cid]
+                                                     for query_idx, qid in enumerate(self.queries_ids) for cid in relevant_docs[qid] if cid in corpus_id_to_idx], dtype=np.int64))
+        self._num_relevant = np.array([len(relevant_docs[qid]) for qid in self.queries_ids])
+
         self.corpus_chunk_size = corpus_chunk_size
         self.mrr_at_k = mrr_at_k
         self.ndcg_at_k = ndcg_at_k
@@ -63,6 +72,10 @@ class InformationRetrievalEvaluator(SentenceEvaluator):
         self.score_functions = score_functions
         self.score_function_names = sorted(list(self.score_functions.keys()))
         self.main_score_function = main_score_function
+        self.cache_corpus_tokenization = cache_corpus_tokenization
+        self.fp16_scores = fp16_scores
+        self._corpus_features_cache = {}       #corpus_start_idx => (length_sorted_idx, list of tokenized batches)
+        self._corpus_features_model_id = None
 
         if name:
             name = "_" + name
@@ -144,39 +157,61 @@ class InformationRetrievalEvaluator(SentenceEvaluator):
         # Compute embedding for the queries
         query_embeddings = model.encode(self.queries, show_progress_bar=self.show_progress_bar, batch_size=self.batch_size, convert_to_tensor=True)
 
-        queries_result_list = {}
-        for name in self.score_functions:
-            queries_result_list[name] = [[] for _ in range(len(query_embeddings))]
+        use_fp16 = self.fp16_scores and query_embeddings.device.type == 'cuda'
+        query_embeddings, normalized_query_embeddings = self._prepare_embeddings(query_embeddings, use_fp16)
+
+        #Running top-k scores and corpus indices per query, merged after each corpus chunk
+        queries_result_scores = {name: None for name in self.score_functions}
+        queries_result_ids = {name: None for name in self.score_functions}
 
         #Iterate over chunks of the corpus
         for corpus_start_idx in trange(0, len(self.corpus), self.corpus_chunk_size, desc='Corpus Chunks', disable=not self.show_progress_bar):
             corpus_end_idx = min(corpus_start_idx + self.corpus_chunk_size, len(self.corpus))
 
             #Encode chunk of corpus
-            if corpus_embeddings is None:
+            if corpus_embeddings is None and self.cache_corpus_tokenization:
+                sub_corpus_embeddings = self._encode_corpus_chunk_cached(corpus_model, corpus_start_idx, corpus_end_idx)
+            elif corpus_embeddings is None:
                 sub_corpus_embeddings = corpus_model.encode(self.corpus[corpus_start_idx:corpus_end_idx], show_progress_bar=False, batch_size=self.batch_size, convert_to_tensor=True)
             else:
                 sub_corpus_embeddings = corpus_embeddings[corpus_start_idx:corpus_end_idx]
 
+            if use_fp16:
+                sub_corpus_embeddings = sub_corpus_embeddings.to(query_embeddings.device)
+            sub_corpus_embeddings, normalized_sub_corpus_embeddings = self._prepare_embeddings(sub_corpus_embeddings, use_fp16)
+
             #Compute cosine similarites
             for name, score_function in self.score_functions.items():
-                pair_scores = score_function(query_embeddings, sub_corpus_embeddings)
+                if score_function is cos_sim:
+                    #Same result as cos_sim, without normalizing the query embeddings again for every corpus chunk
+                    pair_scores = dot_score(normalized_query_embeddings, normalized_sub_corpus_embeddings)
+                else:
+                    pair_scores = score_function(query_embeddings, sub_corpus_embeddings)
 
                 #Get top-k values
                 pair_scores_top_k_values, pair_scores_top_k_idx = torch.topk(pair_scores, min(max_k, len(pair_scores[0])), dim=1, largest=True, sorted=False)
-                pair_scores_top_k_values = pair_scores_top_k_values.cpu().tolist()
-                pair_scores_top_k_idx = pair_scores_top_k_idx.cpu().tolist()
+                pair_scores_top_k_idx += corpus_start_idx
+
+                #Merge with the top-k of the previous corpus chunks
+                if queries_result_scores[name] is not None:
+                    pair_scores_top_k_values = torch.cat([queries_result_scores[name], pair_scores_top_k_values], dim=1)
+                    pair_scores_top_k_idx = torch.cat([queries_result_ids[name], pair_scores_top_k_idx], dim=1)
+                    pair_scores_top_k_values, top_k_order = torch.topk(pair_scores_top_k_values, min(max_k, pair_scores_top_k_values.shape[1]), dim=1, largest=True, sorted=False)
+                    pair_scores_top_k_idx = torch.gather(pair_scores_top_k_idx, 1, top_k_order)
 
-                for query_itr in range(len(query_embeddings)):
-                    for sub_corpus_id, score in zip(pair_scores_top_k_idx[query_itr], pair_scores_top_k_values[query_itr]):
-                        corpus_id = self.corpus_ids[corpus_start_idx+sub_corpus_id]
-                        queries_result_list[name][query_itr].append({'corpus_id': corpus_id, 'score': score})
+                queries_result_scores[name] = pair_scores_top_k_values
+                queries_result_ids[name] = pair_scores_top_k_idx
 
         logger.info("Queries: {}".format(len(self.queries)))
         logger.info("Corpus: {}\n".format(len(self.corpus)))
 
         #Compute scores
-        scores = {name: self.compute_metrics(queries_result_list[name]) for name in self.score_functions}
+        scores = {}
+        for name in self.score_functions:
+            #Rank the final top-k on the device and only transfer the corpus indices
+            _, top_k_order = torch.sort(queries_result_scores[name], dim=1, descending=True)
+            top_k_ids = torch.gather(queries_result_ids[name], 1, top_k_order)
+            scores[name] = self.compute_metrics(top_k_ids.cpu().numpy())
 
         #Output
         for name in self.score_function_names:
@@ -186,91 +221,101 @@ class InformationRetrievalEvaluator(SentenceEvaluator):
         return scores
 
 
-    def compute_metrics(self, queries_result_list: List[object]):
-        # Init score computation values
-        num_hits_at_k = {k: 0 for k in self.accuracy_at_k}
-        precisions_at_k = {k: [] for k in self.precision_recall_at_k}
-        recall_at_k = {k: [] for k in self.precision_recall_at_k}
-        MRR = {k: 0 for k in self.mrr_at_k}
-        ndcg = {k: [] for k in self.ndcg_at_k}
-        AveP_at_k = {k: [] for k in self.map_at_k}
-
-        # Compute scores on results
-        for query_itr in range(len(queries_result_list)):
-            query_id = self.queries_ids[query_itr]
-
-            # Sort scores
-            top_hits = sorted(queries_result_list[query_itr], key=lambda x: x['score'], reverse=True)
-            query_relevant_docs = self.relevant_docs[query_id]
-
-            # Accuracy@k - We count the result correct, if at least one relevant doc is accross the top-k documents
-            for k_val in self.accuracy_at_k:
-                for hit in top_hits[0:k_val]:
-                    if hit['corpus_id'] in query_relevant_docs:
-                        num_hits_at_k[k_val] += 1
-                        break
-
-            # Precision and Recall@k
-            for k_val in self.precision_recall_at_k:
-                num_correct = 0
-                for hit in top_hits[0:k_val]:
-                    if hit['corpus_id'] in query_relevant_docs:
-                        num_correct += 1
-
-                precisions_at_k[k_val].append(num_correct / k_val)
-                recall_at_k[k_val].append(num_correct / len(query_relevant_docs))
-
-            # MRR@k
-            for k_val in self.mrr_at_k:
-                for rank, hit in enumerate(top_hits[0:k_val]):
-                    if hit['corpus_id'] in query_relevant_docs:
-                        MRR[k_val] += 1.0 / (rank + 1)
-                        break
-
-            # NDCG@k
-            for k_val in self.ndcg_at_k:
-                predicted_relevance = [1 if top_hit['corpus_id'] in query_relevant_docs else 0 for top_hit in top_hits[0:k_val]]
-                true_relevances = [1] * len(query_relevant_docs)
-
-                ndcg_value = self.compute_dcg_at_k(predicted_relevance, k_val) / self.compute_dcg_at_k(true_relevances, k_val)
-                ndcg[k_val].append(ndcg_value)
-
-            # MAP@k
-            for k_val in self.map_at_k:
-                num_correct = 0
-                sum_precisions = 0
-
-                for rank, hit in enumerate(top_hits[0:k_val]):
-                    if hit['corpus_id'] in query_relevant_docs:
-                        num_correct += 1
-                        sum_precisions += num_correct / (rank + 1)
-
-                avg_precision = sum_precisions / min(k_val, len(query_relevant_docs))
-                AveP_at_k[k_val].append(avg_precision)
-
-        # Compute averages
-        for k in num_hits_at_k:
-            num_hits_at_k[k] /= len(self.queries)
-
-        for k in precisions_at_k:
-            precisions_at_k[k] = np.mean(precisions_at_k[k])
-
-        for k in recall_at_k:
-            recall_at_k[k] = np.mean(recall_at_k[k])
-
-        for k in ndcg:
-            ndcg[k] = np.mean(ndcg[k])
-
-        for k in MRR:
-            MRR[k] /= len(self.queries)
-
-        for k in AveP_at_k:
-            AveP_at_k[k] = np.mean(AveP_at_k[k])
-
+    def compute_metrics(self, top_k_ids: np.ndarray):
+        """
+        Computes the IR metrics for the ranked corpus indices of each query
+
+        :param top_k_ids: Array of shape (num_queries, k) with the indices (positions in self.corpus_ids) of the retrieved documents, highest score first
+
+        Note: Up to version 2.2.2, compute_metrics expected a list with one list of {'corpus_id': ..., 'score': ...} dicts per query instead.
+        Callers passing such lists have to convert them to the corpus indices, e.g. [[evaluator.corpus_ids.index(hit['corpus_id']) for hit in hits] for hits in queries_result_list]
+        """
+        # is_relevant[i, j] is True if the j-th hit of the i-th query is a relevant document
+        query_offsets = np.arange(len(top_k_ids), dtype=np.int64)[:, None] * len(self.corpus_ids)
+        is_relevant = np.isin(query_offsets + top_k_ids, self._relevant_pair_keys)
+        num_relevant = self._num_relevant
+        num_correct = np.cumsum(is_relevant, axis=1)
+        ranks = np.arange(1, is_relevant.shape[1] + 1)
+
+        # Accuracy@k - We count the result correct, if at least one relevant doc is accross the top-k documents
+        num_hits_at_k = {k: np.mean(is_relevant[:, 0:k].any(axis=1)) for k in self.accuracy_at_k}
+
+        # Precision and Recall@k
+        num_correct_at_k = {k: is_relevant[:, 0:k].sum(axis=1) for k in self.precision_recall_at_k}
+        precisions_at_k = {k: np.mean(num_correct_at_k[k] / k) for k in self.precision_recall_at_k}
+        recall_at_k = {k: np.mean(num_correct_at_k[k] / num_relevant) for k in self.precision_recall_at_k}
+
+        # MRR@k
+        MRR = {}
+        for k_val in self.mrr_at_k:
+            top_hits = is_relevant[:, 0:k_val]
+            reciprocal_rank = np.where(top_hits.any(axis=1), 1.0 / (np.argmax(top_hits, axis=1) + 1), 0.0)
+            MRR[k_val] = np.mean(reciprocal_rank)
+
+        # NDCG@k
+        ndcg = {}
+        discount = self._dcg_discount(max(self.ndcg_at_k))
+        ideal_dcg = np.cumsum(discount)     # ideal_dcg[n-1] is the DCG if the n relevant docs are ranked first
+        for k_val in self.ndcg_at_k:
+            top_hits = is_relevant[:, 0:k_val]
+            dcg = top_hits @ discount[0:top_hits.shape[1]]
+            idcg = ideal_dcg[np.minimum(num_relevant, k_val) - 1]
+            ndcg[k_val] = np.mean(dcg / idcg)
+
+        # MAP@k
+        AveP_at_k = {}
+        for k_val in self.map_at_k:
+            sum_precisions = np.sum(is_relevant[:, 0:k_val] * num_correct[:, 0:k_val] / ranks[0:k_val], axis=1)
+            AveP_at_k[k_val] = np.mean(sum_precisions / np.minimum(k_val, num_relevant))
 
         return {'accuracy@k': num_hits_at_k, 'precision@k': precisions_at_k, 'recall@k': recall_at_k, 'ndcg@k': ndcg, 'mrr@k': MRR, 'map@k': AveP_at_k}
 
 
+    def _prepare_embeddings(self, embeddings: Tensor, use_fp16: bool) -> Tuple[Tensor, Tensor]:
+        """
+        Returns the embeddings and, if cos_sim is one of the score functions, the L2-normalized embeddings (else None).
+        The normalized embeddings are cast to FP16 if use_fp16 is set. The embeddings are kept as they are, as the scores of
+        unnormalized embeddings (dot_score, custom score functions) can exceed the FP16 range
+        """
+        normalized_embeddings = None
+        if any(score_function is cos_sim for score_function in self.score_functions.values()):
+            normalized_embeddings = torch.nn.functional.normalize(embeddings, p=2, dim=1)
+            if use_fp16:
+                normalized_embeddings = normalized_embeddings.half()
+
+        return embeddings, normalized_embeddings
+
+    def _encode_corpus_chunk_cached(self, corpus_model, corpus_start_idx: int, corpus_end_idx: int) -> Tensor:
+        """
+        Computes the embeddings for self.corpus[corpus_start_idx:corpus_end_idx] like corpus_model.encode(..., convert_to_tensor=True).
+        The corpus is only tokenized in the first call, later calls (e.g. at the next evaluation during training) re-use the tokenized batches
+        """
+        if self._corpus_features_model_id != id(corpus_model):
+            self._corpus_features_cache = {}
+            self._corpus_features_model_id = id(corpus_model)
+
+        if corpus_start_idx not in self._corpus_features_cache:
+            sentences = self.corpus[corpus_start_idx:corpus_end_idx]
+            length_sorted_idx = np.argsort([-corpus_model._text_length(sen) for sen in sentences])
+            sentences_sorted = [sentences[idx] for idx in length_sorted_idx]
+            features = [corpus_model.tokenize(sentences_sorted[start_idx:start_idx+self.batch_size]) for start_idx in range(0, len(sentences_sorted), self.batch_size)]
+            self._corpus_features_cache[corpus_start_idx] = (length_sorted_idx, features)
+
+        length_sorted_idx, features = self._corpus_features_cache[corpus_start_idx]
+
+        corpus_model.eval()
+        corpus_model.to(corpus_model._target_device)
+
+        embeddings = []
+        with torch.no_grad():
+            for batch_features in features:
+                #Copy the dict, the model adds its outputs to the features and the cached tensors must stay on the cpu
+                batch_features = batch_to_device(dict(batch_features), corpus_model._target_device)
+                embeddings.append(corpus_model.forward(batch_features)['sentence_embedding'].detach())
+
+        embeddings = torch.cat(embeddings)
+        return embeddings[torch.from_numpy(np.argsort(length_sorted_idx)).to(embeddings.device)]
+
     def output_scores(self, scores):
         for k in scores['accuracy@k']:
             logger.info("Accuracy@{}: {:.2f}%".format(k, scores['accuracy@k'][k]*100))
@@ -293,10 +338,15 @@ class InformationRetrievalEvaluator(SentenceEvaluator):
 
     @staticmethod
     def compute_dcg_at_k(relevances, k):
-        dcg = 0
-        for i in range(min(len(relevances), k)):
-            dcg += relevances[i] / np.log2(i + 2)  #+2 as we start our idx at 0
-        return dcg
+        relevances = np.asarray(relevances[0:k], dtype=float)
+        return float(np.dot(relevances, InformationRetrievalEvaluator._dcg_discount(len(relevances))))
+
+    @staticmethod
+    def _dcg_discount(k: int) -> np.ndarray:
+        """
+        Returns the DCG discount 1/log2(rank+1) for the ranks 1 ... k
+        """
+        return 1 / np.log2(np.arange(2, k + 2))     #+2 as we start our idx at 0
 
 
 
@@ -5,6 +5,9 @@ class InputExample:
     """
     Structure for one input example with texts, the label and a unique id
     """
+    #No per-instance __dict__, which saves memory for datasets with millions of examples
+    __slots__ = ['guid', 'texts', 'label']
+
     def __init__(self, guid: str = '', texts: List[str] = None,  label: Union[int, float] = 0):
         """
         Creates one InputExample with the given texts, guid and label
@@ -4,7 +4,13 @@ Tests that the pretrained models produce the correct scores on the STSbenchmark
 import csv
 import gzip
 import os
+import tempfile
 import unittest
+from unittest import mock
+
+import numpy as np
+import torch
+from transformers import BertConfig, BertForSequenceClassification, BertTokenizer
 
 from torch.utils.data import DataLoader
 import logging
@@ -56,6 +62,105 @@ class CrossEncoderTest(unittest.TestCase):
         self.evaluate_stsb_test(model, 75)
 
 
+class TinyCrossEncoderTest(unittest.TestCase):
+    """
+    Tests on a small, randomly initialized BERT model that is created locally, so no download is needed
+    """
+    words = ['the', 'a', 'cat', 'dog', 'is', 'on', 'table', 'hello', 'world', 'sat', 'mat', 'ran', 'fast', 'slow', 'big', 'small']
+
+    def setUp(self):
+        torch.manual_seed(42)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.model_path = self.tmp_dir.name
+
+        vocab_path = os.path.join(self.model_path, 'vocab.txt')
+        with open(vocab_path, 'w') as fOut:
+            fOut.write("\n".join(['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + self.words))
+
+        config = BertConfig(vocab_size=len(self.words)+5, hidden_size=32, num_hidden_layers=2, num_attention_heads=2, intermediate_size=64, num_labels=1)
+        BertForSequenceClassification(config).save_pretrained(self.model_path)
+        BertTokenizer(vocab_path).save_pretrained(self.model_path)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def sentence(self, num_words):
+        return " ".join(self.words[idx % len(self.words)] for idx in range(num_words))
+
+    def test_compile_model_max_length(self):
+        if not hasattr(torch, 'compile'):
+            self.skipTest("torch.compile requires PyTorch >= 2.0")
+
+        assert CrossEncoder(self.model_path, max_length=128, compile_model=True, device='cpu')._pad_to_multiple_of == 32
+        assert CrossEncoder(self.model_path, max_length=510, compile_model=True, device='cpu')._pad_to_multiple_of == 30
+
+        model = CrossEncoder(self.model_path, max_length=100, compile_model=True, device='cpu')
+        assert model._pad_to_multiple_of == 25
+
+        features, _ = model.smart_batching_collate([InputExample(texts=[self.sentence(3), self.sentence(150)], label=1.0)])
+        assert features['input_ids'].shape[1] == 100
+
+        #[CLS] + 3 words + [SEP] + 5 words + [SEP] = 11 tokens, padded to 25
+        features, _ = model.smart_batching_collate([InputExample(texts=[self.sentence(3), self.sentence(5)], label=1.0)])
+        assert features['input_ids'].shape[1] == 25
+
+        scores = model.predict([[self.sentence(3), self.sentence(5)], [self.sentence(8), self.sentence(150)]])
+        assert scores.shape == (2,)
+
+    def test_predict_batched_matches_single(self):
+        """Tests that sorting the pairs by length and batching them does not change the scores or their order"""
+        model = CrossEncoder(self.model_path, device='cpu')
+        pairs = [[self.sentence(num_words), self.sentence(num_words // 2 + 1)] for num_words in [1, 17, 4, 12, 2, 9, 15]]
+
+        scores = model.predict(pairs, batch_size=3)
+        single_scores = np.array([model.predict(pair) for pair in pairs])
+        assert scores.shape == (len(pairs),)
+        assert np.allclose(scores, single_scores, atol=1e-5)
+
+        scores_tensor = model.predict(pairs, batch_size=3, convert_to_tensor=True)
+        assert np.allclose(scores_tensor.numpy(), single_scores, atol=1e-5)
+
+    def test_fit_gradient_accumulation_steps(self):
+        """Tests the number of optimizer and scheduler steps if the number of batches is not a multiple of gradient_accumulation_steps"""
+        class RecordingAdamW(torch.optim.AdamW):
+            step_lrs = []
+
+            def step(self, closure=None):
+                RecordingAdamW.step_lrs.append(self.param_groups[0]['lr'])
+                return super().step(closure)
+
+        model = CrossEncoder(self.model_path, num_labels=1, device='cpu')
+        train_samples = [InputExample(texts=[self.sentence(num_words), self.sentence(3)], label=float(num_words % 2)) for num_words in range(1, 11)]
+        train_dataloader = DataLoader(train_samples, shuffle=True, batch_size=1)
+
+        #10 batches with 3 accumulation steps => optimizer steps after the batches 3, 6, 9 and 10 in each epoch
+        model.fit(train_dataloader=train_dataloader, epochs=2, warmup_steps=0, optimizer_class=RecordingAdamW, optimizer_params={'lr': 1.0},
+                  gradient_accumulation_steps=3, show_progress_bar=False)
+
+        #WarmupLinear decays the learning rate linearly to 0 over the 8 optimizer steps and is stepped after each of them
+        assert np.allclose(RecordingAdamW.step_lrs, [(8 - step) / 8 for step in range(8)])
+        assert all(param.grad is None for param in model.model.parameters())
+
+    def test_export_onnx(self):
+        """Tests that a model exported to ONNX and loaded with onnxruntime predicts the same scores"""
+        try:
+            import onnxruntime
+        except ImportError:
+            self.skipTest("onnxruntime is not installed")
+
+        model = CrossEncoder(self.model_path, device='cpu')
+        pairs = [[self.sentence(num_words), self.sentence(num_words // 2 + 1)] for num_words in [1, 17, 4, 12, 2]]
+        scores = model.predict(pairs, batch_size=2)
+
+        with tempfile.TemporaryDirectory() as onnx_path:
+            model.export_onnx(onnx_path)
+            onnx_model = CrossEncoder.from_onnx(onnx_path, providers=['CPUExecutionProvider'], device='cpu')
+            with mock.patch.object(onnx_model, '_onnx_forward', wraps=onnx_model._onnx_forward) as onnx_forward:
+                onnx_scores = onnx_model.predict(pairs, batch_size=2)
+            assert onnx_forward.call_count == 3
+
+        assert np.allclose(scores, onnx_scores, atol=1e-5)
+
 
 
 if "__main__" == __name__:
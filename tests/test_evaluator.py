@@ -33,6 +33,29 @@ class EvaluatorTest(unittest.TestCase):
         sklearn_acc = accuracy_score(y_true, y_pred_labels)
         assert np.abs(max_acc - sklearn_acc) < 1e-6
 
+    def test_InformationRetrievalEvaluator_compute_metrics(self):
+        """Tests the IR metrics on a hand-made ranking. The corpus is smaller than k and q1 has a relevant doc that is not in the corpus"""
+        queries = {'q1': 'query 1', 'q2': 'query 2', 'q3': 'query without relevant docs'}
+        corpus = {'c0': 'doc 0', 'c1': 'doc 1', 'c2': 'doc 2', 'c3': 'doc 3'}
+        relevant_docs = {'q1': {'c0', 'c2', 'missing'}, 'q2': {'c3'}}
+        ir_evaluator = evaluation.InformationRetrievalEvaluator(queries, corpus, relevant_docs, accuracy_at_k=[1, 3, 10], precision_recall_at_k=[1, 10],
+                                                                mrr_at_k=[10], ndcg_at_k=[3], map_at_k=[10])
+
+        # q1 finds c0 at rank 2 and c2 at rank 4, q2 finds c3 at rank 4
+        top_k_ids = np.array([[1, 0, 3, 2], [0, 1, 2, 3]])
+        scores = ir_evaluator.compute_metrics(top_k_ids)
+
+        assert scores['accuracy@k'] == {1: 0, 3: 0.5, 10: 1}
+        assert scores['precision@k'][1] == 0
+        assert scores['recall@k'][1] == 0
+        assert np.abs(scores['precision@k'][10] - (2/10 + 1/10) / 2) < 1e-6
+        assert np.abs(scores['recall@k'][10] - (2/3 + 1/1) / 2) < 1e-6
+        assert np.abs(scores['mrr@k'][10] - (1/2 + 1/4) / 2) < 1e-6
+
+        idcg_q1 = 1 + 1/np.log2(3) + 1/np.log2(4)
+        assert np.abs(scores['ndcg@k'][3] - (1/np.log2(3) / idcg_q1 + 0) / 2) < 1e-6
+        assert np.abs(scores['map@k'][10] - ((1/2 + 2/4) / 3 + (1/4) / 1) / 2) < 1e-6
+
     def test_LabelAccuracyEvaluator(self):
         """Tests that the LabelAccuracyEvaluator can be loaded correctly"""
         model = SentenceTransformer('paraphrase-distilroberta-base-v1')